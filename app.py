@@ -1,11 +1,20 @@
-from PIL import Image
+from PIL import Image, ImageSequence
 import io
 import json
 import traceback
 import os
+import sys
+import time
+import uuid
+import secrets
+import cProfile
+import pstats
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, Any, List, Optional
 import httpx
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from pydantic import BaseModel, HttpUrl
 from dotenv import load_dotenv
 from google import genai
@@ -17,11 +26,39 @@ app = FastAPI(title="Medical Bill Extraction API", version="1.0.0")
 # Google Gemini configuration
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 
+# Per-request profiling (disabled unless PROFILE_TOKEN is set)
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_SCOPE = "process" if sys.version_info >= (3, 12) else "thread"  # cProfile uses sys.monitoring on 3.12+
+profile_lock = threading.Lock()
+
+# Near-duplicate detection (perceptual page hashes)
+PAGE_HASH_SIZE = 16  # 16x16 dHash -> 256 bits per page
+PAGE_HASH_DPI = 72   # PDF render resolution for hashing
+NEAR_DUP_THRESHOLD = int(os.getenv("NEAR_DUP_THRESHOLD", "8"))  # Max Hamming distance per page to report a match
+NEAR_DUP_REUSE_THRESHOLD = int(os.getenv("NEAR_DUP_REUSE_THRESHOLD", "2"))  # Max distance per page to reuse a result
+NEAR_DUP_DIR = os.getenv("NEAR_DUP_DIR")  # Persist index + results here (in-memory only if unset)
+
+# Claim bundle processing
+BUNDLE_MAX_WORKERS = int(os.getenv("BUNDLE_MAX_WORKERS", "4"))
+BUNDLE_MAX_FILES = int(os.getenv("BUNDLE_MAX_FILES", "50"))
+BUNDLE_MAX_FILE_BYTES = int(os.getenv("BUNDLE_MAX_FILE_BYTES", str(50 * 1024 * 1024)))     # Per extracted ZIP member
+BUNDLE_MAX_TOTAL_BYTES = int(os.getenv("BUNDLE_MAX_TOTAL_BYTES", str(200 * 1024 * 1024)))  # All extracted ZIP members
+
 class DocumentInput(BaseModel):
     document: HttpUrl 
+    compact: bool = False  # Opt-in positional row output (fewer output tokens)
+    reuse_near_duplicate: bool = False  # Return stored result for a near-identical document (else only report it)
 
-# Enhanced prompt for maximum accuracy with sub-totals and final totals
-PROMPT = """You are an expert medical bill extraction system. Extract ALL line items with PERFECT accuracy.
+class BundleInput(BaseModel):
+    documents: List[HttpUrl] = []     # Claim documents as individual URLs
+    bundle: Optional[HttpUrl] = None  # ...or a single ZIP archive of claim documents
+    compact: bool = False
+    reuse_near_duplicate: bool = False
+
+# Prompt sections shared by the standard and compact wire formats, so both
+# modes give the model identical extraction rules
+PROMPT_INTRO = """You are an expert medical bill extraction system. Extract ALL line items with PERFECT accuracy.
 
 CRITICAL REQUIREMENTS:
 1. Extract EVERY single line item - missing items = FAILURE
@@ -30,7 +67,49 @@ CRITICAL REQUIREMENTS:
 4. Extract the FINAL TOTAL from the bill
 5. Ensure calculated total matches extracted total
 
-OUTPUT SCHEMA (JSON ONLY, NO MARKDOWN):
+"""
+
+PROMPT_RULES = """EXTRACTION RULES:
+1. **Line Items**: Extract ONLY actual billable items, NOT sub-totals or grand totals
+2. **Item Name**: Copy EXACTLY as printed (join multi-line with single space)
+3. **Item Amount**: Net amount after discounts (required, use -1 if missing)
+4. **Item Rate**: Unit price (use -1 if not shown)
+5. **Item Quantity**: Quantity (use -1 if not shown)
+6. **Page Type**: 
+   - "Pharmacy" = medicine/drug items
+   - "Bill Detail" = detailed breakdown with line items
+   - "Final Bill" = summary page with totals
+7. **Section Sub-totals**: Extract sub-totals for sections like:
+   - Pharmacy, Diagnostics, Radiology, Pathology, Room Charges, Consultation, etc.
+8. **Final Total**: Extract the GRAND TOTAL from the bill
+9. **Duplicate Detection**: If same item appears on multiple pages:
+   - Count it ONLY ONCE (prefer detail page over summary page)
+   - Mark in your analysis but don't include twice
+
+VALIDATION CHECKS:
+- Sum of all item_amounts should equal final_total (within ₹1 tolerance)
+- Sum of section subtotals should equal final_total
+- total_item_count must match actual count of bill_items
+- No item should appear twice with same name and amount
+
+EDGE CASES:
+- Discount items: Include as negative amounts
+- Tax items: Include as separate line items
+- Multi-line item names: Join with single space
+- Missing rate/quantity: Set to -1
+- Items without amount: Set to -1
+
+"""
+
+PROMPT_FOOTER = """IMPORTANT: 
+- Return ONLY valid JSON (no markdown, no code blocks, no explanations)
+- All numbers must be numeric types (not strings)
+- Set is_success=true ONLY if extraction is complete and accurate
+- If you cannot extract final_total, set it to -1
+"""
+
+# Enhanced prompt for maximum accuracy with sub-totals and final totals
+PROMPT = PROMPT_INTRO + """OUTPUT SCHEMA (JSON ONLY, NO MARKDOWN):
 {
   "is_success": boolean,
   "token_usage": {
@@ -65,37 +144,7 @@ OUTPUT SCHEMA (JSON ONLY, NO MARKDOWN):
   }
 }
 
-EXTRACTION RULES:
-1. **Line Items**: Extract ONLY actual billable items, NOT sub-totals or grand totals
-2. **Item Name**: Copy EXACTLY as printed (join multi-line with single space)
-3. **Item Amount**: Net amount after discounts (required, use -1 if missing)
-4. **Item Rate**: Unit price (use -1 if not shown)
-5. **Item Quantity**: Quantity (use -1 if not shown)
-6. **Page Type**: 
-   - "Pharmacy" = medicine/drug items
-   - "Bill Detail" = detailed breakdown with line items
-   - "Final Bill" = summary page with totals
-7. **Section Sub-totals**: Extract sub-totals for sections like:
-   - Pharmacy, Diagnostics, Radiology, Pathology, Room Charges, Consultation, etc.
-8. **Final Total**: Extract the GRAND TOTAL from the bill
-9. **Duplicate Detection**: If same item appears on multiple pages:
-   - Count it ONLY ONCE (prefer detail page over summary page)
-   - Mark in your analysis but don't include twice
-
-VALIDATION CHECKS:
-- Sum of all item_amounts should equal final_total (within ₹1 tolerance)
-- Sum of section subtotals should equal final_total
-- total_item_count must match actual count of bill_items
-- No item should appear twice with same name and amount
-
-EDGE CASES:
-- Discount items: Include as negative amounts
-- Tax items: Include as separate line items
-- Multi-line item names: Join with single space
-- Missing rate/quantity: Set to -1
-- Items without amount: Set to -1
-
-EXAMPLE OUTPUT:
+""" + PROMPT_RULES + """EXAMPLE OUTPUT:
 {
   "is_success": true,
   "token_usage": {
@@ -141,12 +190,21 @@ EXAMPLE OUTPUT:
   }
 }
 
-IMPORTANT: 
-- Return ONLY valid JSON (no markdown, no code blocks, no explanations)
-- All numbers must be numeric types (not strings)
-- Set is_success=true ONLY if extraction is complete and accurate
-- If you cannot extract final_total, set it to -1
-"""
+""" + PROMPT_FOOTER
+
+# Compact wire format: positional rows instead of repeated keys.
+# Expanded back to the PROMPT schema by expand_compact_output().
+COMPACT_PROMPT = PROMPT_INTRO + """OUTPUT SCHEMA (COMPACT JSON ONLY, NO MARKDOWN, NO WHITESPACE BETWEEN TOKENS):
+{"is_success":boolean,"pages":[[page_no,page_type,[[item_name,item_amount,item_rate,item_quantity],...]],...],"section_wise_subtotals":[[section_name,subtotal,item_count],...],"final_total":float,"total_item_count":integer}
+
+- Each page is a 3-element array: page_no (string), page_type ("Bill Detail" | "Final Bill" | "Pharmacy"), and its bill items
+- Each bill item is a 4-element array in this EXACT order: [item_name, item_amount, item_rate, item_quantity]
+- Each section subtotal is a 3-element array: [section_name, subtotal, item_count]
+
+""" + PROMPT_RULES + """EXAMPLE OUTPUT:
+{"is_success":true,"pages":[["1","Bill Detail",[["Paracetamol 500mg Tablet",50.0,5.0,10.0],["Complete Blood Count (CBC)",400.0,400.0,1.0]]]],"section_wise_subtotals":[["Pharmacy",50.0,1],["Diagnostics",400.0,1]],"final_total":450.0,"total_item_count":2}
+
+""" + PROMPT_FOOTER
 
 def detect_file_type(url: str, content: bytes, headers):
     """Detect file type from URL, headers, or content"""
@@ -184,6 +242,177 @@ def detect_file_type(url: str, content: bytes, headers):
     return "application/octet-stream", "unknown"
 
 
+def render_pages(content: bytes, kind: str) -> List[Image.Image]:
+    """Render document pages to grayscale PIL images for hashing"""
+    if kind == "image":
+        img = Image.open(io.BytesIO(content))
+        return [frame.convert("L") for frame in ImageSequence.Iterator(img)]
+
+    # PIL cannot rasterize PDFs; PyMuPDF renders the pages
+    try:
+        import fitz
+    except ImportError:
+        return []
+    pages = []
+    with fitz.open(stream=content, filetype="pdf") as doc:
+        for page in doc:
+            pix = page.get_pixmap(dpi=PAGE_HASH_DPI, colorspace=fitz.csGRAY)
+            pages.append(Image.frombytes("L", (pix.width, pix.height), pix.samples))
+    return pages
+
+
+def page_hash(img: Image.Image) -> int:
+    """256-bit difference hash (16x16 dHash) of a page image"""
+    small = img.convert("L").resize((PAGE_HASH_SIZE + 1, PAGE_HASH_SIZE), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(PAGE_HASH_SIZE):
+        for col in range(PAGE_HASH_SIZE):
+            left = pixels[row * (PAGE_HASH_SIZE + 1) + col]
+            right = pixels[row * (PAGE_HASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class PageHashIndex:
+    """
+    Multi-index hash table of page dHashes for near-duplicate lookup
+    
+    Each hash is split into NUM_BANDS bands. Two hashes within `threshold`
+    bits (< NUM_BANDS) must agree exactly on at least one band, so a lookup
+    only checks pages sharing a band bucket instead of scanning the index.
+    Bills sharing a template pile into the same buckets, so a lookup scans
+    only the `max_bucket_size` most recent entries of each bucket. Whole
+    documents are also keyed by their exact page hashes, so identical
+    resubmissions are always found. Candidate documents from any page are
+    verified page by page against their stored hashes.
+    """
+
+    HASH_BITS = PAGE_HASH_SIZE * PAGE_HASH_SIZE
+    NUM_BANDS = 16
+
+    def __init__(self, threshold: int = 8, reuse_threshold: int = 2,
+                 storage_dir: Optional[str] = None, max_bucket_size: int = 64):
+        if not 0 <= threshold < self.NUM_BANDS:
+            raise ValueError(f"threshold must be between 0 and {self.NUM_BANDS - 1}, got {threshold}")
+        if not 0 <= reuse_threshold <= threshold:
+            raise ValueError(f"reuse_threshold must be between 0 and threshold ({threshold}), got {reuse_threshold}")
+        if max_bucket_size < 1:
+            raise ValueError(f"max_bucket_size must be positive, got {max_bucket_size}")
+
+        self.threshold = threshold
+        self.reuse_threshold = reuse_threshold
+        self.max_bucket_size = max_bucket_size
+        width = self.HASH_BITS // self.NUM_BANDS
+        self.bands = [(i * width, (i + 1) * width) for i in range(self.NUM_BANDS)]
+        self.buckets = [{} for _ in self.bands]  # band value -> [(doc_id, page_idx)]
+        self.exact = {}                          # tuple of page hashes -> doc_id
+        self.doc_hashes = {}                     # doc_id -> page hashes
+        self.results = {}                        # doc_id -> stored extraction
+        self.storage_dir = storage_dir
+        self.lock = threading.Lock()
+        if storage_dir:
+            self._load()
+
+    def _band_keys(self, h: int) -> List[int]:
+        return [(h >> start) & ((1 << (end - start)) - 1) for start, end in self.bands]
+
+    def _insert(self, doc_id: str, hashes: List[int]):
+        for page_idx, h in enumerate(hashes):
+            entry = (doc_id, page_idx)
+            for band, key in enumerate(self._band_keys(h)):
+                self.buckets[band].setdefault(key, []).append(entry)
+        self.doc_hashes[doc_id] = list(hashes)
+        self.exact.setdefault(tuple(hashes), doc_id)
+
+    def _load(self):
+        index_path = os.path.join(self.storage_dir, "index.jsonl")
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                self._insert(entry["doc_id"], entry["hashes"])
+
+    def get_result(self, doc_id: str) -> Optional[Dict]:
+        """Load a stored extraction result (memory first, then disk)"""
+        if doc_id in self.results:
+            return self.results[doc_id]
+        if self.storage_dir:
+            result_path = os.path.join(self.storage_dir, f"{doc_id}.json")
+            if os.path.exists(result_path):
+                with open(result_path) as f:
+                    return json.load(f)
+        return None
+
+    def add(self, hashes: List[int], result: Dict) -> str:
+        """Index a document's page hashes and store its extraction result"""
+        doc_id = uuid.uuid4().hex
+        result = json.loads(json.dumps(result))  # Detach from the live response
+        with self.lock:
+            self._insert(doc_id, hashes)
+            if self.storage_dir:
+                os.makedirs(self.storage_dir, exist_ok=True)
+                with open(os.path.join(self.storage_dir, f"{doc_id}.json"), "w") as f:
+                    json.dump(result, f)
+                with open(os.path.join(self.storage_dir, "index.jsonl"), "a") as f:
+                    f.write(json.dumps({"doc_id": doc_id, "hashes": hashes}) + "\n")
+            else:
+                self.results[doc_id] = result
+        return doc_id
+
+    def _candidates(self, hashes: List[int]) -> set:
+        """Exact document match plus documents sharing a band with a page at the same position"""
+        candidates = set()
+        if tuple(hashes) in self.exact:
+            candidates.add(self.exact[tuple(hashes)])
+        for page_idx, h in enumerate(hashes):
+            for band, key in enumerate(self._band_keys(h)):
+                for doc_id, stored_idx in self.buckets[band].get(key, ())[-self.max_bucket_size:]:
+                    if stored_idx == page_idx:
+                        candidates.add(doc_id)
+        return candidates
+
+    def lookup(self, hashes: List[int]) -> Optional[Dict]:
+        """
+        Find a stored document with the same page count whose page i matches
+        query page i within the threshold, for every page
+        """
+        if not hashes:
+            return None
+
+        best_match = None
+        for doc_id in self._candidates(hashes):
+            stored = self.doc_hashes[doc_id]
+            if len(stored) != len(hashes):
+                continue
+            distances = [(h ^ s).bit_count() for h, s in zip(hashes, stored)]
+            if max(distances) > self.threshold:
+                continue
+            confidence = 1 - sum(distances) / (self.HASH_BITS * len(distances))
+            if best_match is None or confidence > best_match["confidence"]:
+                best_match = {
+                    "document_id": doc_id,
+                    "confidence": round(confidence, 4),
+                    "pages_matched": len(distances),
+                    "max_hamming_distance": max(distances),
+                    "reusable": max(distances) <= self.reuse_threshold
+                }
+        return best_match
+
+
+page_index = PageHashIndex(
+    threshold=NEAR_DUP_THRESHOLD,
+    reuse_threshold=NEAR_DUP_REUSE_THRESHOLD,
+    storage_dir=NEAR_DUP_DIR
+)
+
+
+def item_fingerprint(item: Dict) -> str:
+    """Fingerprint used for duplicate detection: name + amount"""
+    return f"{str(item.get('item_name') or '').strip().lower()}_{item.get('item_amount')}"
+
+
 def detect_duplicates(pagewise_items: List[Dict]) -> List[Dict]:
     """Detect duplicate items across pages"""
     seen_items = {}
@@ -191,8 +420,7 @@ def detect_duplicates(pagewise_items: List[Dict]) -> List[Dict]:
     
     for page in pagewise_items:
         for item in page.get('bill_items', []):
-            # Create fingerprint: name + amount
-            fingerprint = f"{item['item_name'].strip().lower()}_{item['item_amount']}"
+            fingerprint = item_fingerprint(item)
             
             if fingerprint in seen_items:
                 # Potential duplicate found
@@ -264,6 +492,80 @@ def validate_extraction(data: Dict) -> Dict:
     return validation
 
 
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def expand_compact_output(compact: Dict) -> Dict:
+    """
+    Expand compact positional model output into the standard response shape
+    Output already in the standard schema is returned unchanged; malformed
+    pages or rows raise ValueError
+    """
+    if not isinstance(compact, dict):
+        raise ValueError("Compact output must be a JSON object")
+    if 'data' in compact:
+        return compact  # Model ignored the compact format but gave a valid extraction
+
+    def _field(row: List, idx: int, default=-1):
+        value = row[idx] if len(row) > idx else None
+        return value if is_number(value) else default
+
+    def _text(row: List, idx: int) -> str:
+        value = row[idx] if len(row) > idx else None
+        return "" if value is None else str(value)
+
+    pages = compact.get('pages', [])
+    if not isinstance(pages, list):
+        raise ValueError("'pages' must be a list")
+
+    pagewise_items = []
+    for page in pages:
+        if not isinstance(page, list) or len(page) != 3 or not isinstance(page[2], list):
+            raise ValueError(f"Page must be [page_no, page_type, items], got {page!r:.100}")
+        bill_items = []
+        for row in page[2]:
+            if not isinstance(row, list):
+                raise ValueError(f"Item must be [name, amount, rate, qty], got {row!r:.100}")
+            bill_items.append({
+                "item_name": _text(row, 0),
+                "item_amount": _field(row, 1),
+                "item_rate": _field(row, 2),
+                "item_quantity": _field(row, 3)
+            })
+        pagewise_items.append({
+            "page_no": _text(page, 0),
+            "page_type": _text(page, 1),
+            "bill_items": bill_items
+        })
+
+    subtotals = []
+    for row in compact.get('section_wise_subtotals', []):
+        if not isinstance(row, list):
+            raise ValueError(f"Subtotal must be [section_name, subtotal, item_count], got {row!r:.100}")
+        subtotals.append({
+            "section_name": _text(row, 0),
+            "subtotal": _field(row, 1),
+            "item_count": _field(row, 2, 0)
+        })
+
+    final_total = compact.get('final_total', -1)
+    return {
+        "is_success": compact.get('is_success') is True,
+        "token_usage": {
+            "total_tokens": -1,
+            "input_tokens": -1,
+            "output_tokens": -1
+        },
+        "data": {
+            "pagewise_line_items": pagewise_items,
+            "section_wise_subtotals": subtotals,
+            "final_total": final_total if is_number(final_total) else -1,
+            "total_item_count": sum(len(page['bill_items']) for page in pagewise_items)
+        }
+    }
+
+
 def encode_file_to_base64(content: bytes, mime_type: str) -> str:
     """Encode file content to base64 for OpenRouter vision API"""
     base64_content = base64.b64encode(content).decode('utf-8')
@@ -299,60 +601,173 @@ def extract_json_from_text(text: str) -> Optional[Dict]:
     return None
 
 
+def upload_to_gemini(content: bytes, kind: str):
+    """Write document to a temp file and upload it to the Gemini Files API"""
+    import tempfile
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf" if kind == "pdf" else ".png") as tmp_file:
+        tmp_file.write(content)
+        tmp_path = tmp_file.name
+    try:
+        return client.files.upload(path=tmp_path)
+    finally:
+        os.unlink(tmp_path)
+
+
+def generate_extraction(uploaded, kind: str, mime_type: str, compact: bool = False):
+    """Call Gemini with the standard or compact extraction prompt"""
+    from google.genai import types
+    prompt = COMPACT_PROMPT if compact else PROMPT
+    prompt_text = f"File type: {kind} (mime: {mime_type})\n\n{prompt}"
+    return client.models.generate_content(
+        model="gemini-2.0-flash-exp",
+        contents=[
+            types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type),
+            prompt_text
+        ]
+    )
+
+
+def get_token_usage(resp) -> Dict:
+    """Read token usage from Gemini response metadata (-1 when unavailable)"""
+    usage = getattr(resp, "usage_metadata", None)
+    return {
+        "total_tokens": getattr(usage, "total_token_count", None) or -1,
+        "input_tokens": getattr(usage, "prompt_token_count", None) or -1,
+        "output_tokens": getattr(usage, "candidates_token_count", None) or -1
+    }
+
+
+def profile_call(func, *args, **kwargs):
+    """
+    Run func under cProfile and save the profile to PROFILE_DIR
+    Returns (result, profile_info); exceptions are re-raised after saving
+    
+    Only one request is profiled at a time (409 otherwise). On Python 3.12+
+    cProfile hooks the whole interpreter, so the profile also includes other
+    threads' work while it runs; profile_info["scope"] reports which applies.
+    """
+    if not profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Another request is already being profiled")
+
+    try:
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profiler = cProfile.Profile()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        result, error = None, None
+
+        try:
+            profiler.enable()
+            result = func(*args, **kwargs)
+        except Exception as e:
+            error = e
+        finally:
+            profiler.disable()
+
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.thread_time() - cpu_start
+        profile_info = {
+            "profile_id": profile_id,
+            "scope": PROFILE_SCOPE,
+            "wall_time_s": round(wall_time, 4),
+            "cpu_time_s": round(cpu_time, 4),
+            "io_wait_s": round(max(wall_time - cpu_time, 0.0), 4)
+        }
+
+        # Save raw stats (for snakeviz / pstats) plus a readable summary
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base_path = os.path.join(PROFILE_DIR, profile_id)
+        with open(f"{base_path}.txt", "w") as f:
+            f.write(json.dumps(profile_info, indent=2) + "\n\n")
+            try:
+                profiler.dump_stats(f"{base_path}.prof")
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(40)
+            except TypeError:
+                f.write("No profile data collected\n")  # enable() failed before anything ran
+    finally:
+        profile_lock.release()
+
+    if error is not None:
+        if not isinstance(error, HTTPException):
+            tb = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+            error = HTTPException(status_code=500, detail=f"Unhandled error: {error}\n{tb}")
+        error.headers = {**(error.headers or {}), "X-Profile-Id": profile_id}
+        raise error
+    return result, profile_info
+
+
 @app.post("/extract-bill-data")
-def extract_bill_data(payload: DocumentInput):
+def extract_bill_data(payload: DocumentInput, x_profile_token: Optional[str] = Header(None)):
     """
     Main endpoint for bill extraction
     Endpoint: POST /extract-bill-data
+
+    Send header X-Profile-Token (must match PROFILE_TOKEN) to profile this request
     """
-    url = str(payload.document)
+    if x_profile_token is None:
+        return run_extraction(payload)
 
-    # Step 1: Fetch document
+    if not PROFILE_TOKEN or not secrets.compare_digest(x_profile_token.encode(), PROFILE_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid profile token")
+
+    result, profile_info = profile_call(run_extraction, payload)
+    result['profile'] = profile_info
+    return result
+
+
+def fetch_document(url: str):
+    """Download a document, returning (content, headers)"""
     try:
         with httpx.Client(timeout=60.0, follow_redirects=True) as client_http:
             resp = client_http.get(url)
             resp.raise_for_status()
-            content = resp.content
-            headers = resp.headers
+            return resp.content, resp.headers
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Cannot fetch URL: {e}")
-    
+
+
+def run_extraction(payload: DocumentInput) -> Dict:
+    """Fetch, extract and validate a single document"""
+    url = str(payload.document)
+
+    # Step 1: Fetch document
+    content, headers = fetch_document(url)
+
+    return extract_document(url, content, headers, payload.compact, payload.reuse_near_duplicate)
+
+
+def extract_document(url: str, content: bytes, headers, compact: bool = False,
+                     reuse_near_duplicate: bool = False) -> Dict:
+    """Extract and validate an already-fetched document (url/filename drives type detection)"""
     # Step 2: Detect file type
     mime_type, kind = detect_file_type(url, content, headers)
     if kind == "unknown":
         raise HTTPException(status_code=400, detail="Could not determine file type (not PDF or image)")
 
+    # Step 2b: Near-duplicate lookup on perceptual page hashes
+    try:
+        hashes = [page_hash(img) for img in render_pages(content, kind)]
+    except Exception:
+        hashes = []
+    near_duplicate = page_index.lookup(hashes)
+    if near_duplicate and near_duplicate["reusable"] and reuse_near_duplicate:
+        stored = page_index.get_result(near_duplicate["document_id"])
+        if stored is not None:
+            result = json.loads(json.dumps(stored))
+            result["token_usage"] = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+            result.setdefault("validation", {})["near_duplicate"] = {**near_duplicate, "reused": True}
+            return result
+
     # Step 3: Upload to Gemini
     try:
-        # Save to temporary file
-        import tempfile
-        import os
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf" if kind == "pdf" else ".png") as tmp_file:
-            tmp_file.write(content)
-            tmp_path = tmp_file.name
-        
-        # Upload to Gemini
-        uploaded = client.files.upload(path=tmp_path)
-        
-        # Clean up temp file
-        os.unlink(tmp_path)
+        uploaded = upload_to_gemini(content, kind)
     except Exception as e:
         tb = traceback.format_exc()
         raise HTTPException(status_code=500, detail=f"Failed to upload file to Gemini: {e}\n{tb}")
 
-    # Step 4: Call Gemini 2.0 Flash with enhanced prompt
-    prompt_text = f"File type: {kind} (mime: {mime_type})\n\n{PROMPT}"
-    
+    # Step 4: Call Gemini 2.0 Flash with enhanced (or compact) prompt
     try:
-        # Using Gemini 1.5 Flash for better rate limits
-        from google.genai import types
-        resp = client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=[
-                types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type),
-                prompt_text
-            ]
-        )
+        resp = generate_extraction(uploaded, kind, mime_type, compact=compact)
     except Exception as e:
         tb = traceback.format_exc()
         raise HTTPException(status_code=500, detail=f"Model call failed: {e}\n{tb}")
@@ -360,6 +775,11 @@ def extract_bill_data(payload: DocumentInput):
     # Step 5: Parse response
     text_out = resp.text if hasattr(resp, "text") else str(resp)
     parsed_json = extract_json_from_text(text_out)
+    if parsed_json is not None and compact:
+        try:
+            parsed_json = expand_compact_output(parsed_json)
+        except Exception:
+            parsed_json = None
     
     if parsed_json is None:
         failure_response = {
@@ -379,15 +799,8 @@ def extract_bill_data(payload: DocumentInput):
         }
         raise HTTPException(status_code=502, detail=json.dumps(failure_response))
 
-    # Step 6: Add token usage from OpenRouter response
-    if 'usage' in openrouter_response:
-        usage = openrouter_response['usage']
-        if 'token_usage' in parsed_json:
-            parsed_json['token_usage'] = {
-                "total_tokens": usage.get('total_tokens', -1),
-                "input_tokens": usage.get('prompt_tokens', -1),
-                "output_tokens": usage.get('completion_tokens', -1)
-            }
+    # Step 6: Add token usage from Gemini response
+    parsed_json['token_usage'] = get_token_usage(resp)
 
     # Step 7: Validate extraction
     if 'data' in parsed_json:
@@ -399,9 +812,340 @@ def extract_bill_data(payload: DocumentInput):
             parsed_json['is_success'] = False
             parsed_json['warning'] = f"Total mismatch: Calculated={validation['calculated_total']}, Extracted={validation['extracted_total']}"
 
+        # Offer (but don't reuse) a near-duplicate match
+        validation['near_duplicate'] = {**near_duplicate, "reused": False} if near_duplicate else None
+
+    # Step 8: Index successful extractions for future near-duplicate lookups
+    # (skip documents already indexed at reuse distance, so resubmissions don't flood buckets)
+    if hashes and parsed_json.get('is_success') and not (near_duplicate and near_duplicate['reusable']):
+        page_index.add(hashes, parsed_json)
+
     return parsed_json
 
 
+def normalize_extraction_data(data: Dict) -> Dict:
+    """Coerce model output fields to the schema types so merging can't fail on bad values"""
+    pages = []
+    for page in data.get('pagewise_line_items') or []:
+        if not isinstance(page, dict):
+            continue
+        items = []
+        for item in page.get('bill_items') or []:
+            if not isinstance(item, dict):
+                continue
+            items.append({
+                "item_name": str(item.get('item_name') or "").strip(),
+                "item_amount": item['item_amount'] if is_number(item.get('item_amount')) else -1,
+                "item_rate": item['item_rate'] if is_number(item.get('item_rate')) else -1,
+                "item_quantity": item['item_quantity'] if is_number(item.get('item_quantity')) else -1
+            })
+        pages.append({
+            "page_no": str(page.get('page_no') or ""),
+            "page_type": str(page.get('page_type') or ""),
+            "bill_items": items
+        })
+
+    sections = []
+    for section in data.get('section_wise_subtotals') or []:
+        if not isinstance(section, dict):
+            continue
+        sections.append({
+            "section_name": str(section.get('section_name') or "Other").strip() or "Other",
+            "subtotal": section['subtotal'] if is_number(section.get('subtotal')) else -1,
+            "item_count": int(section['item_count']) if is_number(section.get('item_count')) else 0
+        })
+
+    return {
+        **data,
+        "pagewise_line_items": pages,
+        "section_wise_subtotals": sections,
+        "final_total": data['final_total'] if is_number(data.get('final_total')) else -1,
+        "total_item_count": sum(len(page['bill_items']) for page in pages)
+    }
+
+
+class ClaimDedupIndex:
+    """
+    Incremental cross-document duplicate index for a claim bundle
+    
+    Keeps a per-document count of each item fingerprint as extractions
+    complete, so repeated rows (e.g. two identical IV cannulisation lines)
+    are compared copy for copy rather than as a single occurrence.
+    """
+
+    def __init__(self):
+        self.counts = {}       # document_index -> {fingerprint: copies}
+        self.locations = {}    # fingerprint -> {document_index: copies}
+        self.items = {}        # fingerprint -> (item_name, item_amount)
+        self.duplicates = []   # fingerprints seen in more than one document
+
+    def add_document(self, doc_idx: int, pagewise_items: List[Dict]):
+        counts = {}
+        for page in pagewise_items:
+            for item in page.get('bill_items', []):
+                fingerprint = item_fingerprint(item)
+                counts[fingerprint] = counts.get(fingerprint, 0) + 1
+                self.items.setdefault(fingerprint, (item['item_name'], item['item_amount']))
+        self.counts[doc_idx] = counts
+
+        for fingerprint, copies in counts.items():
+            locations = self.locations.setdefault(fingerprint, {})
+            if len(locations) == 1:
+                self.duplicates.append(fingerprint)
+            locations[doc_idx] = copies
+
+    def covers(self, outer: int, inner: int) -> bool:
+        """True if every item of `inner` (copy for copy) also appears in `outer`"""
+        inner_counts = self.counts.get(inner, {})
+        outer_counts = self.counts.get(outer, {})
+        return bool(inner_counts) and all(
+            outer_counts.get(fingerprint, 0) >= copies
+            for fingerprint, copies in inner_counts.items()
+        )
+
+    def report(self) -> List[Dict]:
+        """Cross-document repeats, in document order"""
+        return [
+            {
+                "item_name": self.items[fingerprint][0],
+                "item_amount": self.items[fingerprint][1],
+                "copies_by_document": dict(sorted(self.locations[fingerprint].items()))
+            }
+            for fingerprint in self.duplicates
+        ]
+
+
+def is_final_bill(doc: Dict) -> bool:
+    """True if any extracted page of the document is a Final Bill summary page"""
+    return any(page['page_type'] == "Final Bill" for page in doc['data']['pagewise_line_items'])
+
+
+def reconcile_claim(documents: List[Dict], dedup: ClaimDedupIndex) -> Dict:
+    """
+    Decide how each document contributes to the claim
+    
+    - A document whose items all appear (copy for copy) in another document is
+      redundant and excluded entirely.
+    - If a remaining document's total equals the sum of the others (within ₹1)
+      and it has Final Bill pages or sums at least two other documents, it is a
+      summary of them: its total is the claim total, but its items and
+      sections are excluded in favour of the detailed documents.
+    - Otherwise documents are separate bills and everything is summed.
+    Returns {"excluded": {idx: reason}, "summary_index": idx | None,
+             "final_total": float, "method": str}
+    """
+    candidates = [idx for idx, doc in enumerate(documents) if doc.get('data')]
+    excluded = {}
+
+    # Redundant copies: drop the document that is covered (keep the lower index on exact copies)
+    for inner in candidates:
+        for outer in candidates:
+            if outer == inner or outer in excluded:
+                continue
+            if dedup.covers(outer, inner) and not (dedup.covers(inner, outer) and inner < outer):
+                excluded[inner] = f"items repeated in {documents[outer]['document']}"
+                break
+
+    kept = [idx for idx in candidates if idx not in excluded]
+    totals = {idx: documents[idx]['data']['final_total'] for idx in kept}
+
+    if not kept:
+        return {"excluded": excluded, "summary_index": None, "final_total": -1, "method": "unavailable"}
+    if any(total == -1 for total in totals.values()):
+        return {"excluded": excluded, "summary_index": None, "final_total": -1, "method": "unavailable"}
+    if len(kept) == 1:
+        return {"excluded": excluded, "summary_index": None, "final_total": totals[kept[0]], "method": "single_document"}
+
+    # Summary candidates: total equals the sum of the other documents, backed by
+    # positive evidence (Final Bill pages, or at least two documents it sums)
+    summaries = [
+        idx for idx in kept
+        if abs(totals[idx] - (sum(totals.values()) - totals[idx])) <= 1.0
+        and (is_final_bill(documents[idx]) or len(kept) >= 3)
+    ]
+    if summaries:
+        # Prefer Final Bill pages, then fewer (more aggregated) rows, then name - never list order
+        summary = min(summaries, key=lambda idx: (
+            not is_final_bill(documents[idx]),
+            documents[idx]['data']['total_item_count'],
+            documents[idx]['document']
+        ))
+        return {"excluded": excluded, "summary_index": summary, "final_total": totals[summary], "method": "final_bill"}
+    return {"excluded": excluded, "summary_index": None, "final_total": round(sum(totals.values()), 2), "method": "sum_of_documents"}
+
+
+def merge_claim_results(documents: List[Dict], dedup: ClaimDedupIndex) -> Dict:
+    """Merge per-document extractions into a single claim-level data block"""
+    decision = reconcile_claim(documents, dedup)
+    pagewise_items = []
+    sections = {}
+
+    for doc_idx, doc in enumerate(documents):
+        if not doc.get('data') or doc_idx in decision['excluded'] or doc_idx == decision['summary_index']:
+            continue
+        data = doc['data']
+
+        for page in data['pagewise_line_items']:
+            pagewise_items.append({"source_document": doc['document'], **page})
+
+        for section in data['section_wise_subtotals']:
+            merged = sections.setdefault(section['section_name'].lower(), {
+                "section_name": section['section_name'],
+                "subtotal": 0.0,
+                "item_count": 0
+            })
+            if section['subtotal'] != -1:
+                merged['subtotal'] = round(merged['subtotal'] + section['subtotal'], 2)
+                merged['item_count'] += section['item_count']
+
+    excluded_documents = [
+        {"document": documents[idx]['document'], "reason": reason}
+        for idx, reason in sorted(decision['excluded'].items())
+    ]
+    if decision['summary_index'] is not None:
+        excluded_documents.append({
+            "document": documents[decision['summary_index']]['document'],
+            "reason": "summary of the other documents (total used as claim total)"
+        })
+
+    return {
+        "pagewise_line_items": pagewise_items,
+        "section_wise_subtotals": list(sections.values()),
+        "final_total": decision['final_total'],
+        "total_item_count": sum(len(page['bill_items']) for page in pagewise_items),
+        "total_reconciliation": decision['method'],
+        "excluded_documents": excluded_documents
+    }
+
+
+def load_bundle_sources(payload: BundleInput) -> List:
+    """Build (name, loader) pairs; loaders return (content, headers) when called"""
+    if not payload.documents and not payload.bundle:
+        raise HTTPException(status_code=400, detail="Provide 'documents' or 'bundle'")
+    if payload.documents and payload.bundle:
+        raise HTTPException(status_code=400, detail="Provide either 'documents' or 'bundle', not both")
+
+    if payload.documents:
+        urls = [str(url) for url in payload.documents]
+        sources = [(url, lambda url=url: fetch_document(url)) for url in urls]
+    else:
+        content, _ = fetch_document(str(payload.bundle))
+        try:
+            archive = zipfile.ZipFile(io.BytesIO(content))
+        except zipfile.BadZipFile:
+            raise HTTPException(status_code=400, detail="Bundle is not a valid ZIP archive")
+        members = [
+            info for info in archive.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith("__MACOSX/")
+            and not os.path.basename(info.filename).startswith(".")
+        ]
+
+        # Reject zip bombs before anything is decompressed
+        for info in members:
+            if info.file_size > BUNDLE_MAX_FILE_BYTES:
+                raise HTTPException(status_code=400, detail=f"{info.filename} is too large ({info.file_size} bytes, max {BUNDLE_MAX_FILE_BYTES})")
+        if sum(info.file_size for info in members) > BUNDLE_MAX_TOTAL_BYTES:
+            raise HTTPException(status_code=400, detail=f"Bundle is too large when extracted (max {BUNDLE_MAX_TOTAL_BYTES} bytes)")
+
+        sources = [
+            (info.filename, lambda info=info: (read_zip_member(archive, info), {}))
+            for info in members
+        ]
+
+    if not sources:
+        raise HTTPException(status_code=400, detail="Bundle contains no documents")
+    if len(sources) > BUNDLE_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Bundle has {len(sources)} files (max {BUNDLE_MAX_FILES})")
+    return sources
+
+
+def read_zip_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """Read a ZIP member, refusing to decompress past its declared size limit"""
+    with archive.open(info) as f:
+        content = f.read(BUNDLE_MAX_FILE_BYTES + 1)
+    if len(content) > BUNDLE_MAX_FILE_BYTES:
+        raise HTTPException(status_code=400, detail=f"{info.filename} is too large (max {BUNDLE_MAX_FILE_BYTES} bytes)")
+    return content
+
+
+def process_bundle_document(name: str, loader, compact: bool, reuse_near_duplicate: bool) -> Dict:
+    """Fetch and extract one bundle document, capturing failures instead of raising"""
+    try:
+        content, headers = loader()
+        result = extract_document(name, content, headers, compact, reuse_near_duplicate)
+        if 'data' in result:
+            result['data'] = normalize_extraction_data(result['data'])
+    except HTTPException as e:
+        return {"document": name, "is_success": False, "error": e.detail}
+    except Exception as e:
+        return {"document": name, "is_success": False, "error": str(e)}
+    result['document'] = name
+    return result
+
+
+@app.post("/extract-claim-bundle")
+def extract_claim_bundle(payload: BundleInput):
+    """
+    Claim-level extraction over a bundle of documents
+    Endpoint: POST /extract-claim-bundle
+    """
+    sources = load_bundle_sources(payload)
+
+    # Step 1: Extract documents concurrently, deduplicating as results arrive
+    documents = [None] * len(sources)
+    dedup = ClaimDedupIndex()
+    with ThreadPoolExecutor(max_workers=min(BUNDLE_MAX_WORKERS, len(sources))) as pool:
+        futures = {
+            pool.submit(process_bundle_document, name, loader, payload.compact, payload.reuse_near_duplicate): idx
+            for idx, (name, loader) in enumerate(sources)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            documents[idx] = future.result()
+            dedup.add_document(idx, documents[idx].get('data', {}).get('pagewise_line_items', []))
+
+    # Step 2: Merge into one claim
+    data = merge_claim_results(documents, dedup)
+
+    token_usage = {"total_tokens": 0, "input_tokens": 0, "output_tokens": 0}
+    for doc in documents:
+        for key, value in doc.get('token_usage', {}).items():
+            if key in token_usage and value > 0:
+                token_usage[key] += value
+
+    # Step 3: Cross-document validation
+    validation = validate_extraction(data)
+    validation['document_count'] = len(documents)
+    validation['failed_document_count'] = sum(1 for doc in documents if 'data' not in doc)
+    validation['cross_document_duplicate_count'] = len(dedup.duplicates)
+    validation['cross_document_duplicates'] = dedup.report()
+
+    result = {
+        "is_success": all(doc.get('is_success') for doc in documents),
+        "token_usage": token_usage,
+        "data": data,
+        "validation": validation,
+        "documents": [
+            {
+                "document": doc['document'],
+                "is_success": doc.get('is_success', False),
+                "final_total": doc.get('data', {}).get('final_total', -1),
+                "total_item_count": doc.get('data', {}).get('total_item_count', 0),
+                "validation": doc.get('validation'),
+                "error": doc.get('error')
+            }
+            for doc in documents
+        ]
+    }
+
+    if validation.get('has_discrepancy') and validation.get('match_percentage', 0) < 90:
+        result['is_success'] = False
+        result['warning'] = f"Total mismatch: Calculated={validation['calculated_total']}, Extracted={validation['extracted_total']}"
+
+    return result
+
+
 @app.get("/")
 def root():
     """Health check endpoint"""
@@ -428,6 +1172,11 @@ def health():
             "Duplicate detection",
             "Validation",
             "Sub-total extraction",
-            "Final total extraction"
-        ]
+            "Final total extraction",
+            "Compact output mode",
+            "Per-request profiling",
+            "Near-duplicate detection",
+            "Claim bundle processing"
+        ],
+        "profiling_enabled": bool(PROFILE_TOKEN)
     }
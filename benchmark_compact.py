@@ -0,0 +1,92 @@
+"""
+Benchmark standard vs compact output format on the training samples
+Compares output tokens and model latency for each prompt on the same upload
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from app import (
+    upload_to_gemini,
+    generate_extraction,
+    get_token_usage,
+    extract_json_from_text,
+    expand_compact_output,
+)
+
+# Training samples directory
+SAMPLES_DIR = "TRAINING_SAMPLES"
+
+
+def run_mode(uploaded, compact):
+    """Run one extraction and return (latency_s, output_tokens, item_count)"""
+    start = time.perf_counter()
+    resp = generate_extraction(uploaded, "pdf", "application/pdf", compact=compact)
+    latency = time.perf_counter() - start
+
+    output_tokens = get_token_usage(resp)["output_tokens"]
+    parsed = extract_json_from_text(resp.text if hasattr(resp, "text") else str(resp))
+    item_count = -1
+    if parsed is not None and compact:
+        try:
+            parsed = expand_compact_output(parsed)
+        except Exception:
+            parsed = None
+    if parsed is not None:
+        item_count = sum(
+            len(page.get("bill_items", []))
+            for page in parsed.get("data", {}).get("pagewise_line_items", [])
+        )
+    return latency, output_tokens, item_count
+
+
+def main():
+    """Benchmark both output formats on every training sample"""
+    samples_path = Path(SAMPLES_DIR)
+    pdf_files = sorted(samples_path.glob("*.pdf"))
+    if len(sys.argv) > 1:
+        pdf_files = pdf_files[:int(sys.argv[1])]
+    if not pdf_files:
+        print(f"❌ No samples found in {SAMPLES_DIR}/")
+        return
+
+    print(f"🚀 Benchmarking standard vs compact output on {len(pdf_files)} samples\n")
+    print(f"{'Sample':24s} {'Std tok':>8s} {'Cmp tok':>8s} {'Std s':>7s} {'Cmp s':>7s} {'Std items':>10s} {'Cmp items':>10s}")
+    print("-" * 80)
+
+    totals = {"std_tok": 0, "cmp_tok": 0, "std_s": 0.0, "cmp_s": 0.0}
+    failed = 0
+    for i, pdf_file in enumerate(pdf_files):
+        # Alternate which mode runs first so warm-up/caching doesn't favour one
+        modes = [False, True] if i % 2 == 0 else [True, False]
+        try:
+            uploaded = upload_to_gemini(pdf_file.read_bytes(), "pdf")
+            runs = {compact: run_mode(uploaded, compact) for compact in modes}
+        except Exception as e:
+            failed += 1
+            print(f"{pdf_file.name:24s} ❌ {str(e)[:50]}")
+            continue
+        std_s, std_tok, std_items = runs[False]
+        cmp_s, cmp_tok, cmp_items = runs[True]
+
+        totals["std_tok"] += max(std_tok, 0)
+        totals["cmp_tok"] += max(cmp_tok, 0)
+        totals["std_s"] += std_s
+        totals["cmp_s"] += cmp_s
+        print(f"{pdf_file.name:24s} {std_tok:8d} {cmp_tok:8d} {std_s:7.2f} {cmp_s:7.2f} {std_items:10d} {cmp_items:10d}")
+
+    print("-" * 80)
+    print(f"{'TOTAL':24s} {totals['std_tok']:8d} {totals['cmp_tok']:8d} {totals['std_s']:7.2f} {totals['cmp_s']:7.2f}")
+    if totals["std_tok"] > 0:
+        saved = (1 - totals["cmp_tok"] / totals["std_tok"]) * 100
+        print(f"\n💡 Output tokens saved: {saved:.1f}%")
+    if totals["std_s"] > 0:
+        speedup = (1 - totals["cmp_s"] / totals["std_s"]) * 100
+        print(f"⏱️  Latency reduction: {speedup:.1f}%")
+    if failed:
+        print(f"⚠️  {failed} sample(s) failed and were excluded from totals")
+
+
+if __name__ == "__main__":
+    main()
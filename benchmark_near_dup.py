@@ -0,0 +1,119 @@
+"""
+Benchmark near-duplicate lookup latency and recall as the page hash index grows
+Includes template clusters (many bills sharing a layout) to exercise hot buckets
+"""
+
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+
+from app import PageHashIndex, NEAR_DUP_THRESHOLD, NEAR_DUP_REUSE_THRESHOLD
+
+HASH_BITS = PageHashIndex.HASH_BITS
+
+
+def flip_bits(h, count):
+    """Flip `count` random bits of a hash (simulated rescan)"""
+    for bit in random.sample(range(HASH_BITS), count):
+        h ^= 1 << bit
+    return h
+
+
+def distance(a, b):
+    """Max per-page Hamming distance between two documents"""
+    return max((x ^ y).bit_count() for x, y in zip(a, b))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    """Build an index of N pages, then time lookups and check them against ground truth"""
+    total_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    max_bucket_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    template_share = 0.2  # Fraction of documents that are near-copies of a shared template
+    random.seed(42)
+
+    index = PageHashIndex(
+        threshold=NEAR_DUP_THRESHOLD,
+        reuse_threshold=NEAR_DUP_REUSE_THRESHOLD,
+        max_bucket_size=max_bucket_size
+    )
+    templates = [random.getrandbits(HASH_BITS) for _ in range(20)]
+
+    print(f"🚀 Building index with {total_pages:,} pages ({template_share:.0%} of documents from 20 shared templates), "
+          f"scanning {max_bucket_size} entries per bucket...")
+    start = time.perf_counter()
+    plain_docs, template_docs = [], []
+    pages = 0
+    while pages < total_pages:
+        count = random.randint(1, 3)
+        is_template = random.random() < template_share
+        if is_template:
+            hashes = [flip_bits(random.choice(templates), random.randint(0, 4)) for _ in range(count)]
+        else:
+            hashes = [random.getrandbits(HASH_BITS) for _ in range(count)]
+        doc_id = f"doc{len(plain_docs) + len(template_docs)}"
+        index._insert(doc_id, hashes)
+        (template_docs if is_template else plain_docs).append((doc_id, hashes))
+        pages += count
+    print(f"   Built in {time.perf_counter() - start:.1f}s\n")
+
+    # Each query carries the best distance a correct answer must achieve (None = no match exists)
+    def rescans(docs, low, high, n=2000):
+        queries = []
+        for _, hashes in random.sample(docs, n):
+            query = [flip_bits(h, random.randint(low, high)) for h in hashes]
+            queries.append((query, distance(query, hashes)))
+        return queries
+
+    def template_queries(n=200):
+        queries = []
+        for _ in range(n):
+            query = [flip_bits(random.choice(templates), random.randint(0, 4)) for _ in range(random.randint(1, 3))]
+            best = min(
+                (distance(query, hashes) for _, hashes in template_docs if len(hashes) == len(query)),
+                default=None
+            )
+            queries.append((query, best if best is not None and best <= index.threshold else None))
+        return queries
+
+    print("   Computing template ground truth (brute force)...\n")
+    query_sets = {
+        "exact resubmission": rescans(plain_docs + template_docs, 0, 0),
+        "rescan (2-6 bits)": rescans(plain_docs, 2, 6),
+        "templated rescan": rescans(template_docs, 2, 6),
+        "new templated bill": template_queries(),
+        "unseen document": [
+            ([random.getrandbits(HASH_BITS) for _ in range(random.randint(1, 3))], None)
+            for _ in range(2000)
+        ],
+    }
+
+    print(f"{'Query':20s} {'p50 ms':>8s} {'p99 ms':>8s} {'max ms':>8s} {'recall':>8s} {'false +':>8s}")
+    print("-" * 66)
+    for name, queries in query_sets.items():
+        timings = []
+        expected = found = false_positives = 0
+        for query, best in queries:
+            t0 = time.perf_counter()
+            match = index.lookup(query)
+            timings.append((time.perf_counter() - t0) * 1000)
+            if best is None:
+                false_positives += match is not None
+            else:
+                expected += 1
+                # Correct if we found the source or an equally close document
+                found += match is not None and match["max_hamming_distance"] <= best
+        recall = f"{found / expected:.1%}" if expected else "-"
+        print(f"{name:20s} {percentile(timings, 50):8.3f} {percentile(timings, 99):8.3f} "
+              f"{max(timings):8.3f} {recall:>8s} {false_positives:8d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Unit tests for claim bundle merging and cross-document dedup
+Run: python -m pytest test_claim_bundle.py
+"""
+
+import io
+import os
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+import app
+from app import (
+    BundleInput,
+    ClaimDedupIndex,
+    load_bundle_sources,
+    merge_claim_results,
+    normalize_extraction_data,
+    reconcile_claim,
+    validate_extraction,
+)
+
+
+def item(name, amount):
+    return {"item_name": name, "item_amount": amount, "item_rate": -1, "item_quantity": -1}
+
+
+def document(name, page_type, items, sections, total):
+    return {
+        "document": name,
+        "is_success": True,
+        "data": normalize_extraction_data({
+            "pagewise_line_items": [{"page_no": "1", "page_type": page_type, "bill_items": items}],
+            "section_wise_subtotals": [
+                {"section_name": section, "subtotal": subtotal, "item_count": count}
+                for section, subtotal, count in sections
+            ],
+            "final_total": total
+        })
+    }
+
+
+def merge(documents, order=None):
+    dedup = ClaimDedupIndex()
+    for idx in order or range(len(documents)):
+        dedup.add_document(idx, documents[idx]['data']['pagewise_line_items'])
+    data = merge_claim_results(documents, dedup)
+    return data, validate_extraction(data), dedup
+
+
+def pharmacy_receipts():
+    return [
+        document("receipt_1.pdf", "Pharmacy",
+                 [item("Paracetamol", 50), item("Amoxicillin", 450)],
+                 [("Pharmacy", 500, 2)], 500),
+        document("receipt_2.pdf", "Pharmacy",
+                 [item("Paracetamol", 50), item("Cough Syrup", 250)],
+                 [("Pharmacy", 300, 2)], 300),
+    ]
+
+
+def final_bill_bundle():
+    return [
+        document("final_bill.pdf", "Final Bill",
+                 [item("Room Charges", 2000), item("Pharmacy Charges", 1000)],
+                 [("Room", 2000, 1), ("Pharmacy", 1000, 1)], 3000),
+        document("breakup.pdf", "Bill Detail",
+                 [item("General Ward x4", 1600), item("Nursing x4", 400)],
+                 [("Room", 2000, 2)], 2000),
+        document("pharmacy.pdf", "Pharmacy",
+                 [item("Paracetamol", 200), item("Ceftriaxone", 800)],
+                 [("Pharmacy", 1000, 2)], 1000),
+    ]
+
+
+def test_separate_receipts_with_repeat_purchase_are_summed():
+    data, validation, dedup = merge(pharmacy_receipts())
+
+    assert data['final_total'] == 800
+    assert data['total_reconciliation'] == "sum_of_documents"
+    assert data['section_wise_subtotals'] == [{"section_name": "Pharmacy", "subtotal": 800, "item_count": 4}]
+    assert data['total_item_count'] == 4
+    assert validation['calculated_total'] == 800
+    assert not validation['has_discrepancy']
+    # The repeat purchase is reported but kept
+    assert dedup.report() == [{"item_name": "Paracetamol", "item_amount": 50, "copies_by_document": {0: 1, 1: 1}}]
+
+
+def test_final_bill_summarising_breakups_is_not_double_counted():
+    data, validation, _ = merge(final_bill_bundle())
+
+    assert data['final_total'] == 3000
+    assert data['total_reconciliation'] == "final_bill"
+    sections = {s['section_name']: s['subtotal'] for s in data['section_wise_subtotals']}
+    assert sections == {"Room": 2000, "Pharmacy": 1000}
+    assert {page['source_document'] for page in data['pagewise_line_items']} == {"breakup.pdf", "pharmacy.pdf"}
+    assert validation['calculated_total'] == 3000
+    assert validation['match_percentage'] == 100.0
+    assert [d['document'] for d in data['excluded_documents']] == ["final_bill.pdf"]
+
+
+def test_result_does_not_depend_on_completion_order():
+    documents = final_bill_bundle()
+    first, _, _ = merge(documents, order=[0, 1, 2])
+    second, _, _ = merge(documents, order=[2, 0, 1])
+    assert first == second
+
+
+def test_covered_document_is_excluded():
+    documents = [
+        document("final_bill.pdf", "Final Bill",
+                 [item("Room Charges", 2000), item("Paracetamol", 200), item("Ceftriaxone", 800)],
+                 [("Room", 2000, 1), ("Pharmacy", 1000, 2)], 3000),
+        document("pharmacy.pdf", "Pharmacy",
+                 [item("Paracetamol", 200), item("Ceftriaxone", 800)],
+                 [("Pharmacy", 1000, 2)], 1000),
+    ]
+    data, validation, _ = merge(documents)
+
+    assert data['final_total'] == 3000
+    assert data['total_reconciliation'] == "single_document"
+    assert {s['section_name']: s['subtotal'] for s in data['section_wise_subtotals']} == {"Room": 2000, "Pharmacy": 1000}
+    assert validation['calculated_total'] == 3000
+
+
+def test_repeated_rows_are_counted_copy_for_copy():
+    # Two identical rows on one page; the other document has only one copy
+    documents = [
+        document("detail.pdf", "Bill Detail",
+                 [item("IV CANNULISATION", 250), item("IV CANNULISATION", 250), item("Saline", 100)],
+                 [("Procedures", 600, 3)], 600),
+        document("receipt.pdf", "Bill Detail",
+                 [item("IV CANNULISATION", 250)],
+                 [("Procedures", 250, 1)], 250),
+    ]
+    dedup = ClaimDedupIndex()
+    for idx, doc in enumerate(documents):
+        dedup.add_document(idx, doc['data']['pagewise_line_items'])
+
+    assert dedup.covers(0, 1)
+    assert not dedup.covers(1, 0)
+    decision = reconcile_claim(documents, dedup)
+    assert list(decision['excluded']) == [1]
+
+    data = merge_claim_results(documents, dedup)
+    assert data['total_item_count'] == 3
+    assert data['final_total'] == 600
+
+
+def test_identical_documents_keep_one_copy():
+    documents = pharmacy_receipts()[:1] * 2
+    data, validation, _ = merge(documents)
+    assert data['final_total'] == 500
+    assert validation['calculated_total'] == 500
+    assert [d['document'] for d in data['excluded_documents']] == ["receipt_1.pdf"]
+
+
+def test_malformed_model_output_is_normalized():
+    data = normalize_extraction_data({
+        "pagewise_line_items": [{"page_no": 1, "bill_items": [
+            {"item_name": None, "item_amount": "50"},
+            "not an item",
+        ]}],
+        "section_wise_subtotals": [{"section_name": None, "subtotal": "100", "item_count": None}],
+        "final_total": None
+    })
+    assert data['pagewise_line_items'][0]['bill_items'] == [item("", -1)]
+    assert data['section_wise_subtotals'] == [{"section_name": "Other", "subtotal": -1, "item_count": 0}]
+    assert data['final_total'] == -1
+
+    documents = [{"document": "bad.pdf", "is_success": True, "data": data}] + pharmacy_receipts()
+    merged, _, _ = merge(documents)
+    assert merged['total_reconciliation'] == "unavailable"
+
+
+def test_bundle_requires_documents_or_zip():
+    with pytest.raises(HTTPException, match="Provide 'documents' or 'bundle'"):
+        load_bundle_sources(BundleInput())
+    with pytest.raises(HTTPException, match="not both"):
+        load_bundle_sources(BundleInput(documents=["https://example.com/a.pdf"], bundle="https://example.com/b.zip"))
+
+
+def zip_bytes(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, content in members.items():
+            archive.writestr(name, content)
+    return buf.getvalue()
+
+
+def test_zip_bomb_rejected_before_decompression(monkeypatch):
+    bomb = zip_bytes({"bill.pdf": b"\0" * (2 * 1024 * 1024)})
+    monkeypatch.setattr(app, "fetch_document", lambda url: (bomb, {}))
+    monkeypatch.setattr(app, "BUNDLE_MAX_FILE_BYTES", 1024 * 1024)
+    with pytest.raises(HTTPException, match="too large"):
+        load_bundle_sources(BundleInput(bundle="https://example.com/claim.zip"))
+
+
+def test_zip_members_become_sources(monkeypatch):
+    archive = zip_bytes({"bill.pdf": b"%PDF-1.4", "__MACOSX/._bill.pdf": b"x", ".DS_Store": b"x"})
+    monkeypatch.setattr(app, "fetch_document", lambda url: (archive, {}))
+    sources = load_bundle_sources(BundleInput(bundle="https://example.com/claim.zip"))
+    assert [name for name, _ in sources] == ["bill.pdf"]
+    assert sources[0][1]() == (b"%PDF-1.4", {})
+
+
+def test_claim_bundle_endpoint(monkeypatch):
+    documents = {doc['document']: doc for doc in final_bill_bundle()}
+    monkeypatch.setattr(app, "fetch_document", lambda url: (b"", {}))
+
+    def fake_extract(name, content, headers, compact, reuse):
+        doc = documents[name.rsplit("/", 1)[-1]]
+        return {"is_success": True, "token_usage": {"total_tokens": 10, "input_tokens": 8, "output_tokens": 2},
+                "data": doc['data']}
+    monkeypatch.setattr(app, "extract_document", fake_extract)
+
+    result = app.extract_claim_bundle(BundleInput(
+        documents=[f"https://example.com/{name}" for name in documents]
+    ))
+    assert result['is_success']
+    assert result['data']['final_total'] == 3000
+    assert result['validation']['calculated_total'] == 3000
+    assert result['token_usage'] == {"total_tokens": 30, "input_tokens": 24, "output_tokens": 6}
+
+
+def test_equal_totals_without_evidence_are_summed():
+    documents = [
+        document("receipt_1.pdf", "Pharmacy", [item("Paracetamol", 100), item("Amoxicillin", 400)],
+                 [("Pharmacy", 500, 2)], 500),
+        document("receipt_2.pdf", "Pharmacy", [item("Cough Syrup", 250), item("Cetirizine", 250)],
+                 [("Pharmacy", 500, 2)], 500),
+    ]
+    data, validation, _ = merge(documents)
+
+    assert data['final_total'] == 1000
+    assert data['total_reconciliation'] == "sum_of_documents"
+    assert data['excluded_documents'] == []
+    assert validation['calculated_total'] == 1000
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_final_bill_is_summary_in_either_order(reverse):
+    documents = [
+        document("detail.pdf", "Bill Detail", [item("CBC", 400), item("X-Ray", 600)],
+                 [("Diagnostics", 400, 1), ("Radiology", 600, 1)], 1000),
+        document("final.pdf", "Final Bill", [item("Diagnostics", 400), item("Radiology", 600)],
+                 [("Diagnostics", 400, 1), ("Radiology", 600, 1)], 1000),
+    ]
+    if reverse:
+        documents.reverse()
+    data, validation, _ = merge(documents)
+
+    assert data['final_total'] == 1000
+    assert data['total_reconciliation'] == "final_bill"
+    assert [d['document'] for d in data['excluded_documents']] == ["final.pdf"]
+    items = [i['item_name'] for page in data['pagewise_line_items'] for i in page['bill_items']]
+    assert items == ["CBC", "X-Ray"]
+    assert validation['calculated_total'] == 1000
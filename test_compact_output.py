@@ -0,0 +1,99 @@
+"""
+Unit tests for the compact wire format
+Run: python -m pytest test_compact_output.py
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+from app import (
+    COMPACT_PROMPT,
+    PROMPT,
+    PROMPT_FOOTER,
+    PROMPT_INTRO,
+    PROMPT_RULES,
+    expand_compact_output,
+    validate_extraction,
+)
+
+
+def test_expands_positional_rows():
+    result = expand_compact_output({
+        "is_success": True,
+        "pages": [["1", "Bill Detail", [
+            ["Paracetamol 500mg Tablet", 50.0, 5.0, 10.0],
+            ["Complete Blood Count (CBC)", 400.0, 400.0, 1.0],
+        ]]],
+        "section_wise_subtotals": [["Pharmacy", 50.0, 1], ["Diagnostics", 400.0, 1]],
+        "final_total": 450.0,
+        "total_item_count": 2
+    })
+
+    assert result["is_success"] is True
+    data = result["data"]
+    assert data["pagewise_line_items"] == [{
+        "page_no": "1",
+        "page_type": "Bill Detail",
+        "bill_items": [
+            {"item_name": "Paracetamol 500mg Tablet", "item_amount": 50.0, "item_rate": 5.0, "item_quantity": 10.0},
+            {"item_name": "Complete Blood Count (CBC)", "item_amount": 400.0, "item_rate": 400.0, "item_quantity": 1.0},
+        ]
+    }]
+    assert data["section_wise_subtotals"][1] == {"section_name": "Diagnostics", "subtotal": 400.0, "item_count": 1}
+    assert data["final_total"] == 450.0
+    assert data["total_item_count"] == 2
+    assert validate_extraction(data)["calculated_total"] == 450.0
+
+
+def test_short_rows_and_non_numeric_fields_default_to_missing():
+    result = expand_compact_output({
+        "is_success": True,
+        "pages": [[1, "Pharmacy", [["CBC", "400", 400, 1], ["Syringe", 20], [None, None, None, None]]]],
+        "final_total": "450"
+    })
+    items = result["data"]["pagewise_line_items"][0]["bill_items"]
+    assert items[0] == {"item_name": "CBC", "item_amount": -1, "item_rate": 400, "item_quantity": 1}
+    assert items[1] == {"item_name": "Syringe", "item_amount": 20, "item_rate": -1, "item_quantity": -1}
+    assert items[2]["item_name"] == ""
+    assert result["data"]["pagewise_line_items"][0]["page_no"] == "1"
+    assert result["data"]["final_total"] == -1
+    # Validation must not crash on coerced output
+    validate_extraction(result["data"])
+
+
+def test_standard_schema_passes_through():
+    standard = {
+        "is_success": True,
+        "data": {
+            "pagewise_line_items": [],
+            "section_wise_subtotals": [],
+            "final_total": 100.0,
+            "total_item_count": 0
+        }
+    }
+    assert expand_compact_output(standard) is standard
+
+
+@pytest.mark.parametrize("output", [
+    {"pages": [{"page_no": "1", "page_type": "Bill Detail", "rows": []}]},
+    {"pages": [["1", "Bill Detail"]]},
+    {"pages": [["1", "Bill Detail", [{"item_name": "CBC"}]]]},
+    {"pages": "1"},
+    {"section_wise_subtotals": [{"section_name": "Pharmacy"}]},
+    ["not", "an", "object"],
+])
+def test_malformed_output_raises(output):
+    with pytest.raises(ValueError):
+        expand_compact_output(output)
+
+
+def test_prompts_share_rules():
+    for prompt in (PROMPT, COMPACT_PROMPT):
+        assert prompt.startswith(PROMPT_INTRO)
+        assert PROMPT_RULES in prompt
+        assert prompt.endswith(PROMPT_FOOTER)
+    assert '"item_name": "string"' in PROMPT
+    assert "[item_name, item_amount, item_rate, item_quantity]" in COMPACT_PROMPT
@@ -0,0 +1,206 @@
+"""
+Unit tests for near-duplicate detection (perceptual page hashes)
+Run: python -m pytest test_near_duplicate.py
+"""
+
+import io
+import json
+import os
+
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+import app
+from app import PageHashIndex, page_hash, render_pages
+
+SAMPLES_DIR = "TRAINING_SAMPLES"
+
+
+def sample_hashes(n):
+    with open(os.path.join(SAMPLES_DIR, f"train_sample_{n}.pdf"), "rb") as f:
+        return [page_hash(img) for img in render_pages(f.read(), "pdf")]
+
+
+def stored_result(total):
+    return {
+        "is_success": True,
+        "data": {
+            "pagewise_line_items": [],
+            "section_wise_subtotals": [],
+            "final_total": total,
+            "total_item_count": 0
+        }
+    }
+
+
+def test_same_document_is_reusable():
+    index = PageHashIndex()
+    hashes = sample_hashes(1)
+    doc_id = index.add(hashes, stored_result(100))
+
+    match = index.lookup(sample_hashes(1))
+    assert match["document_id"] == doc_id
+    assert match["confidence"] == 1.0
+    assert match["reusable"]
+
+
+def test_reencoded_page_is_offered():
+    with open(os.path.join(SAMPLES_DIR, "train_sample_1.pdf"), "rb") as f:
+        page = render_pages(f.read(), "pdf")[0]
+    buf = io.BytesIO()
+    page.save(buf, "JPEG", quality=90)
+
+    index = PageHashIndex()
+    index.add([page_hash(page)], stored_result(100))
+    match = index.lookup([page_hash(Image.open(io.BytesIO(buf.getvalue())))])
+    assert match is not None
+    assert match["max_hamming_distance"] <= index.threshold
+
+
+def test_same_layout_different_page_is_not_reused():
+    # Pages 2 and 3 of sample 15 share a layout but have different line items
+    hashes = sample_hashes(15)
+    index = PageHashIndex()
+    index.add([hashes[1]], stored_result(15600))
+    match = index.lookup([hashes[2]])
+    assert match is None or not match["reusable"]
+
+
+def test_no_different_training_pages_are_reusable():
+    index = PageHashIndex()
+    pages = [h for n in range(1, 16) for h in sample_hashes(n)]
+    for h in pages:
+        index.add([h], stored_result(1))
+    for h in pages:
+        match = index.lookup([h])
+        # Only the page itself may be reusable (distance 0)
+        assert match["max_hamming_distance"] == 0
+        for other in pages:
+            if other != h:
+                assert (h ^ other).bit_count() > index.reuse_threshold
+
+
+def test_lookup_compares_pages_by_position():
+    index = PageHashIndex()
+    a, b, c = 0, (1 << 256) - 1, int("f0" * 32, 16)
+    index.add([a, b, c], stored_result(1))
+
+    assert index.lookup([a, b, c]) is not None
+    assert index.lookup([a, a, a]) is None
+    assert index.lookup([c, b, a]) is None
+
+
+def test_lookup_requires_same_page_count():
+    index = PageHashIndex()
+    index.add([0, (1 << 256) - 1], stored_result(1))
+    assert index.lookup([0]) is None
+
+
+def test_exact_match_found_after_many_resubmissions():
+    index = PageHashIndex(threshold=2, reuse_threshold=0, max_bucket_size=4)
+    # Many bills with one template hash fill every band bucket past the scan limit
+    for i in range(200):
+        index.add([0], stored_result(i))
+    assert index.lookup([0])["max_hamming_distance"] == 0
+
+
+def test_hot_bucket_is_still_scanned():
+    index = PageHashIndex(threshold=4, reuse_threshold=0, max_bucket_size=4)
+    for i in range(200):
+        index.add([1 << (i % 200)], stored_result(i))
+    # The query differs from page 1 << 199 only in that page's own band, so the
+    # only shared bands are all-zero keys holding ~185 pages each
+    match = index.lookup([(1 << 199) | (1 << 200)])
+    assert match is not None
+    assert match["max_hamming_distance"] == 1
+
+
+def test_candidates_verified_across_all_pages():
+    index = PageHashIndex(max_bucket_size=4)
+    pages = [0, (1 << 256) - 1]
+    index.add(pages, stored_result(1))
+    # Bury page 0's buckets under other documents; page 1 still finds it
+    for i in range(50):
+        index.add([1 << (255 - i), 5], stored_result(i))
+    match = index.lookup([1 << 200, (1 << 256) - 1])
+    assert match is not None
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"threshold": -1},
+    {"threshold": PageHashIndex.NUM_BANDS},
+    {"threshold": 64},
+    {"threshold": 4, "reuse_threshold": 5},
+    {"max_bucket_size": 0},
+])
+def test_invalid_settings_rejected(kwargs):
+    with pytest.raises(ValueError):
+        PageHashIndex(**kwargs)
+
+
+def test_persisted_index_reloads(tmp_path):
+    index = PageHashIndex(storage_dir=str(tmp_path))
+    doc_id = index.add([12345], stored_result(450))
+
+    reloaded = PageHashIndex(storage_dir=str(tmp_path))
+    match = reloaded.lookup([12345 ^ 1])
+    assert match["document_id"] == doc_id
+    assert reloaded.get_result(doc_id)["data"]["final_total"] == 450
+
+
+def test_extract_document_reuse_path(monkeypatch):
+    with open(os.path.join(SAMPLES_DIR, "train_sample_1.pdf"), "rb") as f:
+        content = f.read()
+    index = PageHashIndex()
+    index.add([page_hash(img) for img in render_pages(content, "pdf")], stored_result(450))
+    monkeypatch.setattr(app, "page_index", index)
+
+    # Reuse requested: stored result comes back without calling the model
+    def no_upload(*args, **kwargs):
+        raise AssertionError("model should not be called")
+    monkeypatch.setattr(app, "upload_to_gemini", no_upload)
+    result = app.extract_document("bill.pdf", content, {}, reuse_near_duplicate=True)
+    assert result["data"]["final_total"] == 450
+    assert result["validation"]["near_duplicate"]["reused"]
+    assert result["token_usage"]["output_tokens"] == 0
+
+    # Default: match is only offered, extraction still runs
+    with pytest.raises(HTTPException, match="model should not be called"):
+        app.extract_document("bill.pdf", content, {})
+
+
+class FakeResponse:
+    text = json.dumps({
+        "is_success": True,
+        "data": {
+            "pagewise_line_items": [{"page_no": "1", "page_type": "Bill Detail", "bill_items": [
+                {"item_name": "CBC", "item_amount": 450.0, "item_rate": 450.0, "item_quantity": 1.0}
+            ]}],
+            "section_wise_subtotals": [],
+            "final_total": 450.0,
+            "total_item_count": 1
+        }
+    })
+    usage_metadata = None
+
+
+def test_reusable_match_is_not_reindexed(monkeypatch):
+    index = PageHashIndex()
+    monkeypatch.setattr(app, "page_index", index)
+    monkeypatch.setattr(app, "upload_to_gemini", lambda content, kind: None)
+    monkeypatch.setattr(app, "generate_extraction", lambda *args, **kwargs: FakeResponse())
+
+    with open(os.path.join(SAMPLES_DIR, "train_sample_1.pdf"), "rb") as f:
+        content = f.read()
+    for _ in range(3):
+        result = app.extract_document("bill.pdf", content, {})
+    assert len(index.doc_hashes) == 1
+    assert result["validation"]["near_duplicate"]["reusable"]
+    assert not result["validation"]["near_duplicate"]["reused"]
+
+    with open(os.path.join(SAMPLES_DIR, "train_sample_2.pdf"), "rb") as f:
+        app.extract_document("other.pdf", f.read(), {})
+    assert len(index.doc_hashes) == 2
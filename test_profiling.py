@@ -0,0 +1,98 @@
+"""
+Unit tests for the per-request profiling hook
+Run: python -m pytest test_profiling.py
+"""
+
+import os
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+os.environ.setdefault("GOOGLE_API_KEY", "test")
+
+import app
+
+TOKEN = "s3cret-token"
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "PROFILE_TOKEN", TOKEN)
+    monkeypatch.setattr(app, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "run_extraction", lambda payload: {"is_success": True, "data": {}})
+    return TestClient(app.app, raise_server_exceptions=False)
+
+
+def post(client, headers=None):
+    return client.post("/extract-bill-data", json={"document": "https://example.com/bill.pdf"}, headers=headers or {})
+
+
+def test_unprofiled_request_has_no_profile(client, tmp_path):
+    response = post(client)
+    assert response.status_code == 200
+    assert "profile" not in response.json()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profiled_request_writes_files(client, tmp_path):
+    response = post(client, {"X-Profile-Token": TOKEN})
+    assert response.status_code == 200
+    profile = response.json()["profile"]
+    assert set(profile) == {"profile_id", "scope", "wall_time_s", "cpu_time_s", "io_wait_s"}
+    assert (tmp_path / f"{profile['profile_id']}.prof").exists()
+    assert (tmp_path / f"{profile['profile_id']}.txt").exists()
+
+
+@pytest.mark.parametrize("token", ["wrong", "tökén"])
+def test_invalid_token_rejected(client, token):
+    response = post(client, {"X-Profile-Token": token.encode("latin-1")})
+    assert response.status_code == 403
+
+
+def test_token_rejected_when_profiling_disabled(client, monkeypatch):
+    monkeypatch.setattr(app, "PROFILE_TOKEN", None)
+    assert post(client, {"X-Profile-Token": TOKEN}).status_code == 403
+
+
+@pytest.mark.parametrize("error, status", [
+    (HTTPException(status_code=400, detail="Cannot fetch URL"), 400),
+    (RuntimeError("boom"), 500),
+])
+def test_errors_return_profile_id(client, monkeypatch, tmp_path, error, status):
+    def fail(payload):
+        raise error
+    monkeypatch.setattr(app, "run_extraction", fail)
+
+    response = post(client, {"X-Profile-Token": TOKEN})
+    assert response.status_code == status
+    profile_id = response.headers["X-Profile-Id"]
+    assert (tmp_path / f"{profile_id}.txt").exists()
+
+
+def test_concurrent_profile_rejected(client):
+    app.profile_lock.acquire()
+    try:
+        assert post(client, {"X-Profile-Token": TOKEN}).status_code == 409
+    finally:
+        app.profile_lock.release()
+    assert post(client, {"X-Profile-Token": TOKEN}).status_code == 200
+
+
+def test_profiler_enable_failure_returns_profile_id(client, monkeypatch, tmp_path):
+    # Python 3.12+ raises when another sys.monitoring profiler is active
+    class BusyProfile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+        def disable(self):
+            pass
+
+        def dump_stats(self, path):
+            raise TypeError("no stats")
+
+    monkeypatch.setattr(app.cProfile, "Profile", BusyProfile)
+    response = post(client, {"X-Profile-Token": TOKEN})
+    assert response.status_code == 500
+    assert (tmp_path / f"{response.headers['X-Profile-Id']}.txt").exists()
+    assert not app.profile_lock.locked()